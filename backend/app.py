@@ -1,32 +1,76 @@
 # backend/app.py
+import asyncio
 import os
 import secrets
-from fastapi import FastAPI, Response, Request, HTTPException
-from fastapi.responses import RedirectResponse, JSONResponse
-from dotenv import load_dotenv
-from datetime import datetime, timedelta
+import time
+from collections import defaultdict
+from fastapi import FastAPI, Response, Request, HTTPException, Depends, Query
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import RedirectResponse, ORJSONResponse
+from datetime import datetime, timezone
+from sqlalchemy import Row, bindparam, lambda_stmt, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from backend import spotify_client
 from backend.models import Base, engine, SessionLocal, User, Track, UserTopTrack
 
-load_dotenv()  # loads .env
+# audio-feature fields copied from the Spotify payload into Track columns
+_AUDIO_FEATURE_FIELDS = (
+    "danceability",
+    "energy",
+    "valence",
+    "tempo",
+    "loudness",
+    "speechiness",
+    "acousticness",
+    "instrumentalness",
+    "liveness",
+    "mode",
+    "key",
+    "time_signature",
+)
 
-app = FastAPI(title="Mood Spotify Companion - Backend")
+# orjson encodes the float-heavy Spotify payloads several times faster than
+# the stdlib encoder, shortening CPU-bound stretches on the event loop
+app = FastAPI(title="Mood Spotify Companion - Backend", default_response_class=ORJSONResponse)
+# JSON compresses 5-10x; level 5 is cheap relative to multi-KB payloads
+app.add_middleware(GZipMiddleware, minimum_size=1024, compresslevel=5)
 
-# create DB tables
-Base.metadata.create_all(bind=engine)
+# compiled once per process; avoids rebuilding the same SELECT on every
+# request. Selects plain columns rather than User entities so the hot path
+# skips ORM identity-map bookkeeping and row materialization.
+_user_by_spotify_id = lambda_stmt(
+    lambda: select(
+        User.id,
+        User.spotify_user_id,
+        User.access_token,
+        User.refresh_token,
+        User.token_expires,
+    ).where(User.spotify_user_id == bindparam("sid"))
+)
 
-# helper session
-def get_db():
-    db = SessionLocal()
-    try:
+# create DB tables (async engine, so run at startup instead of import time)
+@app.on_event("startup")
+async def _startup():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+
+# close the shared Spotify HTTP client when the server stops
+@app.on_event("shutdown")
+async def _shutdown():
+    await spotify_client.close_client()
+
+
+# per-request async session dependency
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 @app.get("/auth/login")
-def auth_login():
+async def auth_login():
     # generate state (should be stored in session typically)
     state = secrets.token_urlsafe(16)
     url = spotify_client.build_auth_url(state=state)
@@ -42,121 +86,206 @@ def auth_login():
 
 
 @app.get("/auth/callback")
-def auth_callback(code: str = None, state: str = None):
+async def auth_callback(code: str = None, state: str = None, db: AsyncSession = Depends(get_db)):
     if code is None:
         raise HTTPException(status_code=400, detail="Missing code in callback")
-    token_json = spotify_client.exchange_code_for_token(code)
+    token_json = await spotify_client.exchange_code_for_token(code)
     access_token = token_json["access_token"]
     refresh_token = token_json.get("refresh_token")
     expires_in = token_json.get("expires_in", 3600)
-    expires_at = datetime.utcnow() + timedelta(seconds=int(expires_in))
+    expires_at_epoch = time.time() + int(expires_in)
+    # DB keeps naive UTC datetimes; the cache works in epoch seconds
+    expires_at = datetime.fromtimestamp(expires_at_epoch, timezone.utc).replace(tzinfo=None)
 
     # get user profile
-    profile = spotify_client.get_user_profile(access_token)
+    profile = await spotify_client.get_user_profile(access_token)
     spotify_user_id = profile["id"]
     display_name = profile.get("display_name")
 
-    # store / upsert user
-    db = next(get_db())
-    user = db.query(User).filter(User.spotify_user_id == spotify_user_id).first()
-    if user:
-        user.access_token = access_token
-        user.refresh_token = refresh_token or user.refresh_token
-        user.token_expires = expires_at
-    else:
-        user = User(
-            spotify_user_id=spotify_user_id,
-            display_name=display_name,
-            access_token=access_token,
-            refresh_token=refresh_token,
-            token_expires=expires_at,
+    # store / upsert user: try an UPDATE first, INSERT if nothing matched
+    values = {
+        "display_name": display_name,
+        "access_token": access_token,
+        "token_expires": expires_at,
+    }
+    if refresh_token:
+        values["refresh_token"] = refresh_token
+    result = await db.execute(
+        update(User).where(User.spotify_user_id == spotify_user_id).values(**values)
+    )
+    if result.rowcount == 0:
+        db.add(
+            User(
+                spotify_user_id=spotify_user_id,
+                display_name=display_name,
+                access_token=access_token,
+                refresh_token=refresh_token,
+                token_expires=expires_at,
+            )
         )
-        db.add(user)
-    db.commit()
-    return JSONResponse({"msg": "auth success", "spotify_user_id": spotify_user_id})
-
-
-def ensure_valid_access_token(db_user):
-    # refresh token if expired or near expiry
-    if db_user.token_expires is None or db_user.token_expires <= datetime.utcnow() + timedelta(seconds=60):
-        token_json = spotify_client.refresh_access_token(db_user.refresh_token)
-        access_token = token_json.get("access_token")
-        expires_in = token_json.get("expires_in", 3600)
-        db_user.access_token = access_token
-        db_user.token_expires = datetime.utcnow() + timedelta(seconds=int(expires_in))
-        # sometimes refresh response doesn't return a new refresh_token
-        if "refresh_token" in token_json:
-            db_user.refresh_token = token_json["refresh_token"]
-        db = next(get_db())
-        db.add(db_user)
-        db.commit()
-    return db_user.access_token
+    await db.commit()
+    _cache_token(spotify_user_id, access_token, expires_at_epoch)
+    return {"msg": "auth success", "spotify_user_id": spotify_user_id}
+
+
+# process-local token cache: spotify_user_id -> (access_token, expiry as
+# epoch seconds — cheaper to compare than datetime objects on the hot path).
+# Per-user locks coalesce concurrent refreshes into a single Spotify call.
+_token_cache: dict[str, tuple[str, float]] = {}
+_token_locks: defaultdict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+
+def _cache_token(spotify_user_id: str, access_token: str, expires_at: float):
+    _token_cache[spotify_user_id] = (access_token, expires_at)
+
+
+async def ensure_valid_access_token(db: AsyncSession, user: Row) -> str:
+    # fast path: cached token still valid, skip DB/Spotify entirely
+    cached = _token_cache.get(user.spotify_user_id)
+    if cached and cached[1] > time.time() + 60:
+        return cached[0]
+
+    async with _token_locks[user.spotify_user_id]:
+        # another request may have refreshed while we waited on the lock
+        cached = _token_cache.get(user.spotify_user_id)
+        if cached and cached[1] > time.time() + 60:
+            return cached[0]
+
+        # refresh token if expired or near expiry; persist with an explicit
+        # UPDATE through the caller's session (the lookup returns a plain
+        # row, not a mutable ORM object)
+        access_token = user.access_token
+        expires_at = (
+            user.token_expires.replace(tzinfo=timezone.utc).timestamp()
+            if user.token_expires is not None
+            else None
+        )
+        if expires_at is None or expires_at <= time.time() + 60:
+            token_json = await spotify_client.refresh_access_token(user.refresh_token)
+            access_token = token_json.get("access_token")
+            if not access_token:
+                raise HTTPException(status_code=502, detail="token refresh failed")
+            expires_in = token_json.get("expires_in", 3600)
+            expires_at = time.time() + int(expires_in)
+            values = {
+                "access_token": access_token,
+                "token_expires": datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None),
+            }
+            # sometimes refresh response doesn't return a new refresh_token
+            if "refresh_token" in token_json:
+                values["refresh_token"] = token_json["refresh_token"]
+            await db.execute(update(User).where(User.id == user.id).values(**values))
+            await db.commit()
+        _cache_token(user.spotify_user_id, access_token, expires_at)
+    return access_token
+
+
+# Spotify profiles change rarely; cache them for a few minutes so /api/me
+# doesn't pay a Spotify round trip per call. Refreshed inline on expiry.
+_profile_cache: dict[str, tuple[dict, float]] = {}
+_PROFILE_TTL = 300  # seconds
 
 
 @app.get("/api/me")
-def api_me(spotify_user_id: str):
-    db = next(get_db())
-    user = db.query(User).filter(User.spotify_user_id == spotify_user_id).first()
+async def api_me(
+    spotify_user_id: str = Query(..., min_length=1, max_length=64, pattern=r"^[A-Za-z0-9_\-\.]+$"),
+    db: AsyncSession = Depends(get_db),
+):
+    entry = _profile_cache.get(spotify_user_id)
+    if entry and time.monotonic() - entry[1] < _PROFILE_TTL:
+        return entry[0]
+
+    user = (
+        await db.execute(_user_by_spotify_id, {"sid": spotify_user_id})
+    ).first()
     if not user:
         raise HTTPException(status_code=404, detail="user not found")
     # ensure token valid
-    access_token = ensure_valid_access_token(user)
-    profile = spotify_client.get_user_profile(access_token)
+    access_token = await ensure_valid_access_token(db, user)
+    profile = await spotify_client.get_user_profile(access_token)
+    _profile_cache[spotify_user_id] = (profile, time.monotonic())
     return profile
 
 
 @app.get("/api/top-tracks")
-def api_top_tracks(spotify_user_id: str, limit: int = 50):
-    db = next(get_db())
-    user = db.query(User).filter(User.spotify_user_id == spotify_user_id).first()
+async def api_top_tracks(
+    spotify_user_id: str = Query(..., min_length=1, max_length=64, pattern=r"^[A-Za-z0-9_\-\.]+$"),
+    limit: int = Query(50, ge=1, le=50),  # Spotify's hard cap
+    db: AsyncSession = Depends(get_db),
+):
+    user = (
+        await db.execute(_user_by_spotify_id, {"sid": spotify_user_id})
+    ).first()
     if not user:
         raise HTTPException(status_code=404, detail="user not found")
-    access_token = ensure_valid_access_token(user)
-    top_tracks_json = spotify_client.get_user_top_tracks(access_token, limit=limit)
+    access_token = await ensure_valid_access_token(db, user)
+    top_tracks_json = await spotify_client.get_user_top_tracks(access_token, limit=limit)
     items = top_tracks_json.get("items", [])
 
-    # store/update tracks and user_top_tracks
-    for idx, item in enumerate(items):
-        spotify_track_id = item["id"]
-        name = item["name"]
-        artists = ", ".join([a["name"] for a in item["artists"]])
-        album = item["album"]["name"]
-
-        db_track = db.query(Track).filter(Track.spotify_track_id == spotify_track_id).first()
-        if not db_track:
-            db_track = Track(
-                spotify_track_id=spotify_track_id,
-                name=name,
-                artist=artists,
-                album=album,
-                audio_features=None,
+    # store/update tracks and user_top_tracks; one IN (...) query up front
+    # instead of one SELECT per item, then bulk inserts
+    track_ids = [item["id"] for item in items]
+    track_id_map = {
+        spotify_id: pk
+        for pk, spotify_id in await db.execute(
+            select(Track.id, Track.spotify_track_id).where(
+                Track.spotify_track_id.in_(track_ids)
             )
-            db.add(db_track)
-            db.commit()
-        # add user_top_tracks link
-        utt = UserTopTrack(user_id=user.id, track_id=db_track.id, rank=idx + 1)
-        db.add(utt)
-    db.commit()
+        )
+    }
+    new_rows = [
+        {
+            "spotify_track_id": item["id"],
+            "name": item["name"],
+            "artist": ", ".join([a["name"] for a in item["artists"]]),
+            "album": item["album"]["name"],
+        }
+        for item in items
+        if item["id"] not in track_id_map
+    ]
+    if new_rows:
+        # RETURNING hands back the new ids in the same round trip, so no
+        # re-query is needed to build the link rows
+        inserted = await db.execute(
+            sqlite_insert(Track).values(new_rows).returning(Track.id, Track.spotify_track_id)
+        )
+        track_id_map.update({spotify_id: pk for pk, spotify_id in inserted})
+
+    # add user_top_tracks links in a single bulk insert
+    rows = [
+        {"user_id": user.id, "track_id": track_id_map[item["id"]], "rank": idx + 1}
+        for idx, item in enumerate(items)
+        if item["id"] in track_id_map
+    ]
+    if rows:
+        # single multi-row INSERT; duplicates of (user_id, track_id, rank)
+        # from repeat fetches are dropped instead of erroring
+        await db.execute(sqlite_insert(UserTopTrack).values(rows).on_conflict_do_nothing())
 
     # after storing basic metadata, fetch audio features
-    track_ids = [t["id"] for t in items]
     if track_ids:
         # split into chunks of 100 if necessary; here limit is small
-        audio_features_json = spotify_client.get_audio_features(access_token, track_ids)
+        audio_features_json = await spotify_client.get_audio_features(access_token, track_ids)
 
         if not audio_features_json or audio_features_json.get("audio_features") is None:
             audio_features_json = {"audio_features": []}
-        
-        af_list = audio_features_json.get("audio_features", [])
-        # map and update Track.audio_features
-        for af in af_list:
-            if not af:
-                continue
-            spotify_id = af["id"]
-            db_track = db.query(Track).filter(Track.spotify_track_id == spotify_id).first()
-            if db_track:
-                db_track.audio_features = af
-                db.add(db_track)
-        db.commit()
+
+        af_list = [af for af in audio_features_json.get("audio_features", []) if af]
+        if af_list:
+            # the id map built above already covers every fetched track
+            await db.execute(
+                update(Track),
+                [
+                    {
+                        "id": track_id_map[af["id"]],
+                        **{field: af.get(field) for field in _AUDIO_FEATURE_FIELDS},
+                    }
+                    for af in af_list
+                    if af["id"] in track_id_map
+                ],
+            )
+
+    # single commit: tracks, links, and audio features share one fsync
+    await db.commit()
 
     return {"fetched": len(items)}
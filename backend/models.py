@@ -2,22 +2,40 @@
 from sqlalchemy import (
     Column,
     Integer,
+    Float,
     String,
     DateTime,
     Text,
-    JSON,
-    create_engine,
+    Index,
+    UniqueConstraint,
+    event,
 )
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-import datetime
+from datetime import datetime, timezone
 import os
 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./dev.db")
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./dev.db")
 
 Base = declarative_base()
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
-SessionLocal = sessionmaker(bind=engine)
+# pooled async engine: connections are reused across requests instead of
+# being opened per session, and sync SQLite I/O no longer blocks the loop
+engine = create_async_engine(
+    DATABASE_URL, pool_size=10, max_overflow=20, pool_pre_ping=True
+)
+SessionLocal = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+# WAL lets readers run while a writer commits, and synchronous=NORMAL halves
+# the fsyncs per commit; both are safe for this single-node dev database
+@event.listens_for(engine.sync_engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _):
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-20000")
+    cur.close()
 
 
 class User(Base):
@@ -32,18 +50,40 @@ class User(Base):
 
 class Track(Base):
     __tablename__ = "tracks"
+    # mood queries filter on valence/energy ranges, so index that pair
+    __table_args__ = (Index("ix_tracks_valence_energy", "valence", "energy"),)
     id = Column(Integer, primary_key=True, index=True)
     spotify_track_id = Column(String, unique=True, index=True)
     name = Column(String, nullable=False)
     artist = Column(String, nullable=True)
     album = Column(String, nullable=True)
-    audio_features = Column(JSON, nullable=True)
+    # Spotify audio features as typed columns instead of a JSON blob:
+    # no re-parse on read, and range filters can use indexes
+    danceability = Column(Float, nullable=True)
+    energy = Column(Float, nullable=True)
+    valence = Column(Float, nullable=True)
+    tempo = Column(Float, nullable=True)
+    loudness = Column(Float, nullable=True)
+    speechiness = Column(Float, nullable=True)
+    acousticness = Column(Float, nullable=True)
+    instrumentalness = Column(Float, nullable=True)
+    liveness = Column(Float, nullable=True)
+    mode = Column(Integer, nullable=True)
+    key = Column(Integer, nullable=True)
+    time_signature = Column(Integer, nullable=True)
 
 
 class UserTopTrack(Base):
     __tablename__ = "user_top_tracks"
+    __table_args__ = (
+        UniqueConstraint("user_id", "track_id", "rank", name="uq_utt"),
+        Index("ix_utt_user_time", "user_id", "retrieved_at"),
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, nullable=False)
     track_id = Column(Integer, nullable=False)
     rank = Column(Integer, nullable=True)
-    retrieved_at = Column(DateTime, default=datetime.datetime.utcnow)
\ No newline at end of file
+    # naive-UTC, consistent with the token_expires writes in app.py
+    retrieved_at = Column(
+        DateTime, default=lambda: datetime.now(timezone.utc).replace(tzinfo=None)
+    )
\ No newline at end of file
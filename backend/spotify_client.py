@@ -7,10 +7,12 @@ Spotify helper client used by the FastAPI app.
 - Reads credentials from environment variables when available
 """
 
+import asyncio
 import os
 import base64
+import re
 from dotenv import load_dotenv
-import requests
+import httpx
 from urllib.parse import urlencode
 from typing import List, Optional, Dict, Any
 
@@ -39,6 +41,21 @@ SCOPES = "user-read-private user-read-email user-top-read user-read-recently-pla
 
 # -----------------------
 
+# Shared async client: reuses TCP connections and multiplexes requests over
+# HTTP/2, so we pay the TLS handshake to Spotify once per process instead of
+# once per call. Closed from the app's shutdown hook via close_client().
+_client = httpx.AsyncClient(
+    base_url=SPOTIFY_API_BASE,
+    timeout=httpx.Timeout(10.0, connect=3.0),
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+)
+
+
+async def close_client():
+    await _client.aclose()
+
+
 def build_auth_url(state: str) -> str:
     params = {
         "client_id": CLIENT_ID,
@@ -50,50 +67,51 @@ def build_auth_url(state: str) -> str:
     }
     return f"{SPOTIFY_AUTH_URL}?{urlencode(params)}"
 
+# client id/secret are process constants, so encode the Basic header once
+_BASIC_AUTH = {
+    "Authorization": "Basic "
+    + base64.b64encode(f"{CLIENT_ID}:{CLIENT_SECRET}".encode()).decode()
+}
+
 def _basic_auth_header() -> Dict[str, str]:
-    key = f"{CLIENT_ID}:{CLIENT_SECRET}".encode()
-    b64 = base64.b64encode(key).decode()
-    return {"Authorization": f"Basic {b64}"}
+    return _BASIC_AUTH
 
-def exchange_code_for_token(code: str) -> Dict[str, Any]:
+async def exchange_code_for_token(code: str) -> Dict[str, Any]:
     data = {
         "grant_type": "authorization_code",
         "code": code,
         "redirect_uri": REDIRECT_URI,
     }
-    headers = _basic_auth_header()
-    resp = requests.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+    resp = await _client.post(SPOTIFY_TOKEN_URL, data=data, headers=_BASIC_AUTH)
     resp.raise_for_status()
     return resp.json()
 
-def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
+async def refresh_access_token(refresh_token: str) -> Dict[str, Any]:
     data = {"grant_type": "refresh_token", "refresh_token": refresh_token}
-    headers = _basic_auth_header()
-    resp = requests.post(SPOTIFY_TOKEN_URL, data=data, headers=headers)
+    resp = await _client.post(SPOTIFY_TOKEN_URL, data=data, headers=_BASIC_AUTH)
     resp.raise_for_status()
     return resp.json()
 
-def api_get(path: str, access_token: str, params: Optional[Dict[str, Any]] = None) -> Any:
+async def api_get(path: str, access_token: str, params: Optional[Dict[str, Any]] = None) -> Any:
     """
     Wrapper around GET to Spotify API. Prints helpful debug info on error,
     including response headers (these sometimes include clues).
     """
     if not path.startswith("/"):
         path = "/" + path
-    url = f"{SPOTIFY_API_BASE}{path}"
     headers = {"Authorization": f"Bearer {access_token}"}
 
     if DEBUG:
         try:
-            print(f"DEBUG: api_get -> {url} params={params} token_preview={access_token[:8]}...")
+            print(f"DEBUG: api_get -> {SPOTIFY_API_BASE}{path} params={params} token_preview={access_token[:8]}...")
         except Exception:
             pass
 
     # print("ACCESS_TOKEN =", access_token)
 
-    r = requests.get(url, headers=headers, params=params)
+    r = await _client.get(path, headers=headers, params=params)
 
-    if not r.ok:
+    if not r.is_success:
         # Try to parse json error body, fall back to text
         try:
             err_body = r.json()
@@ -109,21 +127,28 @@ def api_get(path: str, access_token: str, params: Optional[Dict[str, Any]] = Non
         print("=========================")
 
         # Raise with context so caller sees the body
-        raise requests.HTTPError(f"{r.status_code} Error calling {r.url}: {err_body}", response=r)
+        raise httpx.HTTPStatusError(
+            f"{r.status_code} Error calling {r.url}: {err_body}", request=r.request, response=r
+        )
 
     try:
         return r.json()
     except ValueError:
         return r.text
 
-def get_user_profile(access_token: str) -> Dict[str, Any]:
-    return api_get("/me", access_token)
+async def get_user_profile(access_token: str) -> Dict[str, Any]:
+    return await api_get("/me", access_token)
 
-def get_user_top_tracks(access_token: str, limit: int = 50, time_range: str = "medium_term") -> Dict[str, Any]:
+async def get_user_top_tracks(access_token: str, limit: int = 50, time_range: str = "medium_term") -> Dict[str, Any]:
     params = {"limit": limit, "time_range": time_range}
-    return api_get("/me/top/tracks", access_token, params=params)
+    return await api_get("/me/top/tracks", access_token, params=params)
 
 # ---- Helpers for audio features ----
+# track ids are 22 base62 chars at the end of a URI/URL path; one compiled
+# regex replaces the strip/startswith/split chain in batch paths
+_ID_RE = re.compile(r"([A-Za-z0-9]{22})$")
+
+
 def _normalize_track_id(t: str) -> Optional[str]:
     """
     Accepts spotify:track:<id>, https://open.spotify.com/track/<id>?si=..., or raw id
@@ -131,23 +156,30 @@ def _normalize_track_id(t: str) -> Optional[str]:
     """
     if not t:
         return None
-    t = t.strip()
-    if t.startswith("spotify:"):
-        return t.split(":")[-1]
-    if "open.spotify.com" in t:
-        # URL might be like /track/<id> or /track/<id>?si=...
-        return t.split("/")[-1].split("?")[0]
-    return t
+    m = _ID_RE.search(t.strip().split("?", 1)[0])
+    return m.group(1) if m else None
 
 
-def get_audio_features(access_token: str, track_ids: list):
+async def get_audio_features(access_token: str, track_ids: list):
     """
-    Spotify has restricted /audio-features for new apps.
-    This function now fails gracefully instead of crashing the API.
+    Spotify accepts at most 100 ids per /audio-features call, so split the
+    ids into 100-id windows and fetch them concurrently. A failed chunk is
+    logged and skipped rather than poisoning the whole batch (Spotify has
+    restricted /audio-features for new apps, so failures are expected).
     """
-    try:
-        ids = ",".join(track_ids)
-        return api_get("/audio-features", access_token, params={"ids": ids})
-    except Exception as e:
-        print("⚠️ Audio features unavailable:", e)
-        return {"audio_features": None}
+    ids = [i for i in map(_normalize_track_id, track_ids) if i]
+    chunks = [ids[i:i + 100] for i in range(0, len(ids), 100)]
+    results = await asyncio.gather(
+        *[
+            api_get("/audio-features", access_token, params={"ids": ",".join(chunk)})
+            for chunk in chunks
+        ],
+        return_exceptions=True,
+    )
+    features: List[Any] = []
+    for chunk, result in zip(chunks, results):
+        if isinstance(result, BaseException):
+            print(f"⚠️ Audio features unavailable for {len(chunk)} ids:", result)
+            continue
+        features.extend(result.get("audio_features") or [])
+    return {"audio_features": features or None}